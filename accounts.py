@@ -1,6 +1,12 @@
+import heapq
+import itertools
+import math
 from util import Ledger, Dist
 
 class Base(object):
+	# Attributes that change during a run, saved by save() and put back by restore()
+	state = ('year', 'month', 'months')
+
 	def __init__(self):
 		self.start_year = 2020
 		self.start_month = 1
@@ -8,21 +14,74 @@ class Base(object):
 		self.end_month = 1
 		self.year = 2020
 		self.month = 1
+		self.months = 1
 		self.name = 'flow'
+		self.solvency = None
+		self.series = None
+		self.series_start = 0
 
 	def set_name(self, n):
 		self.name = n
 		return self
 
-	def update(self, year, month, market=0):
+	def save(self):
+		return tuple(getattr(self, attr) for attr in self.state)
+
+	def restore(self, saved):
+		for attr, val in zip(self.state, saved):
+			setattr(self, attr, val)
+
+	def precompute(self, start, end):
+		"""
+		Precompute the parts of this flow that are the same in every run from start to end
+		"""
+		pass
+
+	def growth(self, value, increase, start, end):
+		"""
+		value for each year from start to end when it goes up by a fixed increase every January
+		"""
+		if increase is None or not increase.constant():
+			return None
+		series = []
+		for year in range(start, end):
+			value += value * increase.mean
+			series.append(value)
+		return series
+
+	def grow(self, value, increase):
+		"""
+		value after this year's increase
+		"""
+		if self.series is not None:
+			return self.series[self.year - self.series_start]
+		return value + value * increase.get()
+
+	def update(self, year, month, market=0, months=1):
+		"""
+		Advance to the step of length months ending at year/month. For steps
+		longer than a month, market is the market's annual (mean, std) and the
+		step's standard normal draw, shared by every account.
+		"""
 		self.year = year
 		self.month = month
 		self.market = market
+		self.months = months
+		if months > 1:
+			# Flows ask for the window several times a step, so work it out once
+			lo, hi = self.window()
+			self.step_months = max(hi - lo + 1, 0)
 		self._update()
 
 	def _update(self):
 		pass
 
+	def settle(self):
+		"""
+		Finish a step longer than a month, after the step's flows
+		"""
+		pass
+
 	def start(self, year, month=0):
 		self.start_year = year
 		self.start_month = month
@@ -39,11 +98,40 @@ class Base(object):
 		return self
 
 	def is_current(self):
-		if self.year < self.start_year or (self.year == self.start_year and self.month < self.start_month):
-			return False
-		if self.year > self.end_year or (self.year == self.end_year and self.month > self.end_month):
-			return False
-		return True
+		if self.months == 1:
+			# Monthly steps (the usual case) don't need the whole window
+			if self.year < self.start_year or (self.year == self.start_year and self.month < self.start_month):
+				return False
+			if self.year > self.end_year or (self.year == self.end_year and self.month > self.end_month):
+				return False
+			return True
+		return self.step_months > 0
+
+	def window(self):
+		"""
+		First and last month (as year * 12 + month - 1) of the current step that are between start and end
+		"""
+		last = self.year * 12 + self.month - 1
+		lo = max(last - self.months + 1, self.start_year * 12 + max(self.start_month, 1) - 1)
+		hi = min(last, self.end_year * 12 + self.end_month - 1)
+		return lo, hi
+
+	def current_months(self):
+		if self.months == 1:
+			return 1 if self.is_current() else 0
+		return self.step_months
+
+	def active_months(self):
+		"""
+		Months (1-12) of the current step that are between start and end
+		"""
+		if self.months == 1:
+			return [self.month] if self.is_current() else []
+		lo, hi = self.window()
+		return [i % 12 + 1 for i in range(lo, hi + 1)]
+
+	def new_year(self):
+		return self.month - self.months < 1
 
 	def get():
 		return 0
@@ -60,10 +148,19 @@ class Base(object):
 			if amt <= 0.001:
 				break
 			amt -= acct.withdraw(amt, self.name)
-		if amt > 0:
-			raise Exception('Not enough in accounts to pay ${:.2f} for {} on {}/{}'.format(self.amt, self.name, self.month, self.year))
+		if amt > 0.001:
+			self.shortfall(amt, accounts)
+
+	def shortfall(self, amt, accounts):
+		if self.solvency is None:
+			raise Exception('Not enough in accounts to pay ${:.2f} for {} on {}/{}'.format(amt, self.name, self.month, self.year))
+		self.solvency.record(self.year, self.month, self.name, amt)
+		if self.solvency.deficit and accounts:
+			accounts[0].deposit(-amt, self.name)
 
 class Account(Base):
+	state = Base.state + ('basis', 'gain')
+
 	def __init__(self, total=0, basis=0, beta=0, alpha=None, tax_rate=0, category=None):
 		super().__init__()
 		self.basis = basis
@@ -73,6 +170,8 @@ class Account(Base):
 		self.tax_rate = tax_rate
 		self.category = category
 		self.ledger = []
+		self.recording = True
+		self.after = 0
 
 	def __str__(self):
 		out = []
@@ -82,23 +181,48 @@ class Account(Base):
 			out.append(str(item))
 		return '\n'.join(out)
 
+	def restore(self, saved):
+		super().restore(saved)
+		self.ledger.clear()
+
 	def rate(self):
 		if self.alpha is None:
 			return 0
-		return self.market * self.beta + self.alpha.get_monthly()
+		if self.months == 1:
+			return self.market * self.beta + self.alpha.get_monthly()
+		# One log-normal draw for the whole step, with the same mean and spread as
+		# compounding its monthly returns
+		mean, std, z = self.market or (0, 0, 0)
+		m = (mean * self.beta + self.alpha.mean) / 12
+		v = ((std * self.beta) ** 2 + self.alpha.std ** 2) / 12
+		noise = std * self.beta * z + self.alpha.get() - self.alpha.mean
+		return math.exp(self.months * (math.log(1 + m) - v / (2 * (1 + m) ** 2)) + math.sqrt(self.months / 12) * noise / (1 + m)) - 1
 
 	def balance(self):
 		return self.basis + self.gain
 
 	def _update(self):
-		amt = self.balance() * self.rate()
+		r = self.rate()
+		if self.months > 1:
+			# Split the step's growth around its flows so they land mid-step. Monthly flows
+			# come after that month's growth, so on average (months - 1) / 2 months from the end.
+			self.after = (1 + r) ** ((self.months - 1) / (2 * self.months)) - 1
+			r = (1 + r) / (1 + self.after) - 1
+		self.apply_rate(r)
+
+	def settle(self):
+		if self.months > 1:
+			self.apply_rate(self.after)
+
+	def apply_rate(self, r):
+		amt = self.balance() * r
 		self.gain += amt
-		if abs(amt) > 0.001:
+		if self.recording and abs(amt) > 0.001:
 			self.ledger.append(Ledger(self.year, self.month, 'Gain', amt, 0, self.balance()))
 
 	def deposit(self, amt, note):
 		self.basis += amt
-		if abs(amt) > 0.001:
+		if self.recording and abs(amt) > 0.001:
 			self.ledger.append(Ledger(self.year, self.month, note, amt, 0, self.balance()))
 
 	def withdraw(self, amt, note):
@@ -106,12 +230,12 @@ class Account(Base):
 			return 0
 		bal = self.balance()
 		if bal < amt:
-			amt = bal
+			amt = max(bal, 0)
 		pct = 0 if bal == 0 else self.gain / bal
 		a = amt / (1 - pct * self.tax_rate)
 		self.basis -= a * (1 - pct)
 		self.gain -= a * pct
-		if abs(amt) > 0.001:
+		if self.recording and abs(amt) > 0.001:
 			self.ledger.append(Ledger(self.year, self.month, note, -amt, -a * pct * self.tax_rate, self.balance()))
 		return amt
 
@@ -152,7 +276,149 @@ class Account(Base):
 		return self
 
 
+class LotAccount(Account):
+	"""
+	An account that tracks the cost basis of each purchase (lot) instead of a single
+	average. Holdings are units of a price that starts at 1 and moves with the account's
+	returns. Withdrawals sell lots in order from a heap: highest cost first ('hifo') or
+	oldest first ('fifo'). Gains on lots held at least a year are taxed at tax_rate and
+	others at short_tax_rate, and realized losses offset later gains. Deficits (negative
+	deposits) sell lots with tax, unlike Account, which takes them out of basis and
+	leaves the gain to be taxed by later withdrawals. Deficits the lots can't cover are
+	owed, and paid back from later deposits before they buy lots.
+	"""
+	state = Account.state + ('price', 'losses', 'owed')
+
+	def __init__(self, total=0, basis=0, beta=0, alpha=None, tax_rate=0, short_tax_rate=None, order='hifo', category=None):
+		super().__init__(total, basis, beta, alpha, tax_rate, category)
+		self.short_tax_rate = tax_rate if short_tax_rate is None else short_tax_rate
+		self.order = order
+		self.price = 1.0
+		self.losses = 0
+		self.owed = 0
+		self.seq = itertools.count()
+		self.lots = []
+		if total > 0:
+			# Whatever is already in the account counts as long-term
+			self.add_lot(total, basis / total, -12)
+
+	def add_lot(self, units, cost, acquired):
+		priority = (-cost, acquired) if self.order == 'hifo' else (acquired, -cost)
+		heapq.heappush(self.lots, [priority, next(self.seq), units, cost, acquired])
+
+	def save(self):
+		return super().save(), [list(lot) for lot in self.lots]
+
+	def restore(self, saved):
+		saved, lots = saved
+		super().restore(saved)
+		self.lots = [list(lot) for lot in lots]
+
+	def now(self):
+		return self.year * 12 + self.month - 1
+
+	def apply_rate(self, r):
+		# Only the lots grow, not what's owed
+		amt = (self.balance() + self.owed) * r
+		self.price *= 1 + r
+		self.gain += amt
+		if self.recording and abs(amt) > 0.001:
+			self.ledger.append(Ledger(self.year, self.month, 'Gain', amt, 0, self.balance()))
+
+	def deposit(self, amt, note):
+		if amt < 0:
+			# Negative deposits (e.g. deficits) sell lots like a withdrawal, tax included,
+			# so their gains don't go untaxed. Whatever the lots can't cover is owed.
+			value, cost, tax = self.sell(-amt)
+			self.basis -= cost
+			self.gain -= value - cost
+			short = -amt - (value - tax)
+			self.owed += short
+			self.basis -= short
+			if self.recording:
+				self.ledger.append(Ledger(self.year, self.month, note, amt, -tax, self.balance()))
+			return
+		if amt > 0:
+			repaid = min(amt, self.owed)
+			self.owed -= repaid
+			if amt > repaid:
+				self.add_lot((amt - repaid) / self.price, self.price, self.now())
+		super().deposit(amt, note)
+
+	def sell(self, net):
+		"""
+		Sell lots in heap order until they bring in net after tax.
+		Returns the value sold, its cost basis and the tax on it.
+		"""
+		value = cost = tax = 0
+		while net > 0.001 and self.lots:
+			lot = self.lots[0]
+			units, lot_cost, acquired = lot[2], lot[3], lot[4]
+			rate = self.tax_rate if self.now() - acquired >= 12 else self.short_tax_rate
+			lot_value = units * self.price
+			gain = units * (self.price - lot_cost)
+			# Realized losses carried forward offset this lot's gain, if it's taxed
+			offset = min(self.losses, gain) if gain > 0 and rate > 0 else 0
+			lot_tax = max(gain - offset, 0) * rate
+			if lot_value - lot_tax > net:
+				# Sell part of the lot: find the fraction whose after-tax value is net
+				if gain <= 0 or gain * rate == 0:
+					f = net / lot_value
+				elif net <= lot_value * self.losses / gain:
+					f = net / lot_value
+				else:
+					f = (net - self.losses * rate) / (lot_value - gain * rate)
+				lot[2] -= units * f
+				units, lot_value, gain = units * f, lot_value * f, gain * f
+				offset = min(self.losses, gain) if gain > 0 and rate > 0 else 0
+				lot_tax = max(gain - offset, 0) * rate
+			else:
+				heapq.heappop(self.lots)
+			self.losses += -gain if gain < 0 else -offset
+			value += lot_value
+			cost += units * lot_cost
+			tax += lot_tax
+			net -= lot_value - lot_tax
+		return value, cost, tax
+
+	def withdraw(self, amt, note):
+		if not self.is_current() or amt <= 0:
+			return 0
+		value, cost, tax = self.sell(amt)
+		self.basis -= cost
+		self.gain -= value - cost
+		if self.recording and abs(value) > 0.001:
+			self.ledger.append(Ledger(self.year, self.month, note, -(value - tax), -tax, self.balance()))
+		return value - tax
+
+	def harvest(self, note='Tax-loss harvest'):
+		"""
+		Sell and rebuy every lot whose cost is above the current price, banking the loss to offset later gains
+		"""
+		if self.order == 'hifo':
+			# Lots at a loss have the highest cost, so they're at the top of the heap
+			lots = []
+			while self.lots and self.lots[0][3] > self.price:
+				lots.append(heapq.heappop(self.lots))
+		else:
+			lots = [lot for lot in self.lots if lot[3] > self.price]
+			self.lots = [lot for lot in self.lots if lot[3] <= self.price]
+			heapq.heapify(self.lots)
+		losses = 0
+		for lot in lots:
+			losses += lot[2] * (lot[3] - self.price)
+			self.add_lot(lot[2], self.price, self.now())
+		self.losses += losses
+		self.basis -= losses
+		self.gain += losses
+		if self.recording and losses > 0.001:
+			self.ledger.append(Ledger(self.year, self.month, '{} (${:,.2f} loss)'.format(note, losses), 0, 0, self.balance()))
+		return self
+
+
 class Income(Base):
+	state = Base.state + ('annually',)
+
 	def __init__(self, annually, increase, bonus=0, bonus_month=2, every_n_month=1):
 		super().__init__()
 		self.annually = annually
@@ -164,18 +430,30 @@ class Income(Base):
 	def rate(self):
 		return self.increase.get()
 
+	def precompute(self, start, end):
+		self.series = self.growth(self.annually, self.increase, start, end)
+		self.series_start = start
+
 	def _update(self):
-		if self.month == 1:
-			self.annually += self.annually * self.rate()
+		if self.new_year():
+			self.annually = self.grow(self.annually, self.increase)
 
 	def get(self):
-		if not self.is_current():
-			return 0
+		if self.months == 1:
+			if not self.is_current():
+				return 0
+			amt = 0
+			if self.month % self.every_n_month == 0:
+				amt += self.annually / (12 / self.every_n_month)
+			if self.month == self.bonus_month:
+				amt += self.annually * self.bonus_pct
+			return amt
 		amt = 0
-		if self.month % self.every_n_month == 0:
-			amt += self.annually / (12 / self.every_n_month)
-		if self.month == self.bonus_month:
-			amt += self.annually * self.bonus_pct
+		for month in self.active_months():
+			if month % self.every_n_month == 0:
+				amt += self.annually / (12 / self.every_n_month)
+			if month == self.bonus_month:
+				amt += self.annually * self.bonus_pct
 		return amt
 
 
@@ -189,12 +467,12 @@ class RSU(Base):
 		self.price = price
 
 	def get(self):
-		if not self.is_current():
-			return 0
-		if self.month % 3 == 1:
+		if self.months == 1:
+			if not self.is_current() or self.month % 3 != 1:
+				return 0
 			return self.quarterly_qty * self.price.balance()
-		else:
-			return 0
+		vests = len([month for month in self.active_months() if month % 3 == 1])
+		return vests * self.quarterly_qty * self.price.balance()
 
 
 class Mortgage(Account):
@@ -206,7 +484,14 @@ class Mortgage(Account):
 
 	def _update(self):
 		if self.is_current():
-			self.interest = -self.balance() * self.rate / 12
+			# Amortize over the months in this step, assuming each payment is made in full
+			self.paid_months = self.current_months()
+			self.interest = 0
+			owed = -self.balance()
+			for i in range(self.paid_months):
+				interest = owed * self.rate / 12
+				self.interest += interest
+				owed -= self.payment - interest
 			self.deposit(-self.interest, 'Interest')
 
 	def interest_outof(self, accts):
@@ -215,10 +500,12 @@ class Mortgage(Account):
 
 	def principal_outof(self, accts):
 		if self.is_current():
-			self.outof(self.payment - self.interest, accts)
+			self.outof(self.payment * self.paid_months - self.interest, accts)
 
 
 class Expense(Base):
+	state = Base.state + ('base',)
+
 	def __init__(self, monthly=None, annually=None, variation=0, increase=None):
 		super().__init__()
 		self.amt = monthly or annually / 12
@@ -226,26 +513,37 @@ class Expense(Base):
 		self.monthly_dist = Dist(1, variation/self.amt)
 		self.increase = increase
 
+	def precompute(self, start, end):
+		self.series = self.growth(self.base, self.increase, start, end)
+		self.series_start = start
+
 	def _update(self):
-		if self.month == 1 and self.increase is not None:
-			self.base += self.base * self.increase.get()
+		if self.new_year() and self.increase is not None:
+			self.base = self.grow(self.base, self.increase)
 
 	def get(self):
-		if not self.is_current():
+		months = self.current_months()
+		if months == 0:
 			return 0
-		return self.monthly_dist.get() * self.base * self.amt
+		return self.monthly_dist.get_total(months) * self.base * self.amt
 
 
 class Transfer(Base):
+	state = Base.state + ('amt',)
+
 	def __init__(self, annually=None, monthly=None, increase=None):
 		super().__init__()
 		self.amt = monthly or annually / 12
 		self.increase = increase
 
+	def precompute(self, start, end):
+		self.series = self.growth(self.amt, self.increase, start, end)
+		self.series_start = start
+
 	def _update(self):
-		if self.month == 1 and self.increase is not None:
-			self.amt += self.amt * self.increase.get()		
+		if self.new_year() and self.increase is not None:
+			self.amt = self.grow(self.amt, self.increase)
 
 	def go(self, srcs, dst):
 		if self.is_current():
-			dst.outof(self.amt, srcs)
+			dst.outof(self.amt * self.current_months(), srcs)
@@ -0,0 +1,145 @@
+
+import fcntl
+import hashlib
+import inspect
+import json
+import os
+import pickle
+import tempfile
+import numpy as np
+from util import Dist
+from accounts import Base
+
+M = 1000*1000
+
+# Bump to invalidate every cached result, e.g. when the format of cached values changes
+ENGINE_VERSION = 1
+
+# Source files whose contents are part of every key, so changing the simulation invalidates the cache
+ENGINE_FILES = ['accounts.py', 'optimize.py', 'shard.py', 'sim.py', 'taxes.py', 'util.py']
+
+# Flow attributes that hold run state rather than parameters
+STATE = ['ledger', 'solvency', 'market', 'months', 'interest', 'paid_months', 'series', 'series_start', 'seq', 'after', 'step_months', 'recording']
+
+def canonical(obj, top=True):
+	"""
+	A JSON-serializable description of obj that is the same for equal inputs
+	"""
+	if isinstance(obj, Dist):
+		return ['Dist', obj.mean, obj.std]
+	if isinstance(obj, Base):
+		if not top:
+			# Flows that refer to other flows (e.g. RSU prices) refer to them by name
+			return ['ref', obj.name]
+		return [type(obj).__name__, { k: canonical(v, False) for k, v in sorted(vars(obj).items()) if k not in STATE }]
+	if isinstance(obj, np.ndarray):
+		return ['array', hashlib.sha256(np.ascontiguousarray(obj).tobytes()).hexdigest()]
+	if isinstance(obj, dict):
+		return [[canonical(k, top), canonical(v, top)] for k, v in sorted(obj.items(), key=lambda kv: repr(kv[0]))]
+	if isinstance(obj, (list, tuple)):
+		return [canonical(v, top) for v in obj]
+	if isinstance(obj, (np.integer, np.floating)):
+		return obj.item()
+	if obj is None or isinstance(obj, (bool, int, float, str)):
+		return obj
+	raise Exception('Can\'t make a cache key from {}'.format(type(obj).__name__))
+
+def model_key(model):
+	"""
+	The model's flows and parameters as set up by setup(), plus the source files
+	defining its class, which cover its run() rules and any module-level constants
+	and helpers they use. None if the source isn't available (e.g. a class defined
+	in a REPL or notebook), so the results aren't cached.
+	"""
+	model.reset()
+	flows = [[kind, [canonical(flow) for name, flow in sorted(getattr(model, kind).items())]]
+		for kind in ['incomes', 'expenses', 'accounts', 'transfers']]
+	params = { k: v for k, v in vars(model).items() if isinstance(v, (bool, int, float, str)) and k not in STATE + ['year', 'month'] }
+	source = []
+	for cls in type(model).__mro__:
+		if cls.__module__ in ('builtins', 'sim'):
+			continue
+		try:
+			with open(inspect.getsourcefile(cls), 'rb') as f:
+				source.append(hashlib.sha256(f.read()).hexdigest())
+		except (OSError, TypeError):
+			return None
+	return [flows, canonical(params), source]
+
+
+class ResultCache(object):
+	"""
+	Persistent cache of results keyed by a hash of their inputs. Entries are
+	written atomically so several processes can share a cache directory, and
+	the least recently used entries are deleted once it grows past max_bytes.
+	"""
+	def __init__(self, path='.cache', max_bytes=256*M):
+		self.path = path
+		self.max_bytes = max_bytes
+		self.engine = None
+		os.makedirs(path, exist_ok=True)
+
+	def engine_version(self):
+		if self.engine is None:
+			h = hashlib.sha256(str(ENGINE_VERSION).encode())
+			root = os.path.dirname(os.path.abspath(__file__))
+			for name in ENGINE_FILES:
+				with open(os.path.join(root, name), 'rb') as f:
+					h.update(f.read())
+			self.engine = h.hexdigest()
+		return self.engine
+
+	def key(self, *parts):
+		data = json.dumps([self.engine_version(), canonical(list(parts))], sort_keys=True)
+		return hashlib.sha256(data.encode()).hexdigest()
+
+	def file(self, key):
+		return os.path.join(self.path, key[:2], key)
+
+	def get(self, key):
+		try:
+			with open(self.file(key), 'rb') as f:
+				value = pickle.load(f)
+			# Reads count as use for LRU eviction
+			os.utime(self.file(key))
+			return value
+		except (FileNotFoundError, EOFError, pickle.UnpicklingError):
+			return None
+
+	def put(self, key, value):
+		os.makedirs(os.path.dirname(self.file(key)), exist_ok=True)
+		fd, tmp = tempfile.mkstemp(dir=self.path, prefix='.tmp')
+		with os.fdopen(fd, 'wb') as f:
+			pickle.dump(value, f)
+		os.replace(tmp, self.file(key))
+		self.evict()
+
+	def cached(self, key, compute):
+		value = self.get(key)
+		if value is None:
+			value = compute()
+			self.put(key, value)
+		return value
+
+	def evict(self):
+		with open(os.path.join(self.path, '.lock'), 'w') as lock:
+			fcntl.flock(lock, fcntl.LOCK_EX)
+			entries = []
+			for d in os.listdir(self.path):
+				if d.startswith('.'):
+					continue
+				for name in os.listdir(os.path.join(self.path, d)):
+					try:
+						st = os.stat(os.path.join(self.path, d, name))
+					except FileNotFoundError:
+						continue
+					entries.append((st.st_mtime, st.st_size, os.path.join(self.path, d, name)))
+			total = sum(size for mtime, size, path in entries)
+			for mtime, size, path in sorted(entries):
+				if total <= self.max_bytes:
+					break
+				try:
+					os.remove(path)
+				except FileNotFoundError:
+					pass
+				total -= size
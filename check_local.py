@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+
+"""
+Checks the job server and sharded runs on localhost.
+
+	python check_local.py [workers] [--optimize]
+
+Starts worker processes and a job server on free ports, then checks that
+merging 1 shard and several shards gives the same result, and that the job
+server's results match running the same simulations locally. The model fails
+often, so some chunks and shards have no values for later years. With
+--optimize it also checks sharded optimizer trials, which downloads prices.
+"""
+
+import asyncio
+import json
+import os
+import subprocess
+import sys
+
+import server
+from accounts import Account, Expense
+from shard import Coordinator
+from sim import MC, Model
+from util import Dist
+
+START = 2021
+END = 2060
+
+
+class Fragile(Model):
+	def setup(self):
+		self.account('Checking', Account(total=20000, category='Cash'))
+		self.account('Stocks', Account(total=300000, beta=1.5, alpha=Dist(0, 0.02), category='Investments'))
+		self.expense('Living', Expense(monthly=1500, variation=400, increase=Dist(0.03, 0.01)))
+
+	def run(self):
+		self.expense('Living').outof([self.account('Checking'), self.account('Stocks')])
+
+
+def start_workers(count):
+	root = os.path.dirname(os.path.abspath(__file__))
+	procs, addrs = [], []
+	for i in range(count):
+		proc = subprocess.Popen([sys.executable, '-u', os.path.join(root, 'shard.py'), 'worker', '0'], stdout=subprocess.PIPE, text=True, cwd=root)
+		# Worker listening on host:port
+		host, port = proc.stdout.readline().split()[-1].rsplit(':', 1)
+		procs.append(proc)
+		addrs.append((host, int(port)))
+	return procs, addrs
+
+def check_shards(addrs, n):
+	spec = 'check_local:Fragile'
+	for deficit in (False, True):
+		one = Coordinator(addrs).mc(spec, START, END, n, deficit=deficit, shards=1)
+		many = Coordinator(addrs).mc(spec, START, END, n, deficit=deficit, shards=n // 3)
+		assert json.dumps(one.to_json()) == json.dumps(many.to_json()), 'shards differ (deficit={})'.format(deficit)
+		assert one.failures() > 0
+	print('MC: 1 shard and {} shards match'.format(n // 3))
+
+def check_trials(addrs, n):
+	import optimize
+	portfolio = optimize.Portfolio(['VTI', 'LQD'], n=n, taxed_account=True, chunk=n // 4)
+	opt = optimize.Optimizer(portfolio, init=1000000, goal=2200000, years=10)
+	strategy = optimize.EqualStrategy(portfolio, contributions=5000)
+	one = Coordinator(addrs).trial(opt, strategy, 17, shards=1)
+	many = Coordinator(addrs).trial(opt, strategy, 17, shards=4)
+	local = opt.partial(strategy)
+	assert json.dumps(one.to_json()) == json.dumps(many.to_json()) == json.dumps(local.to_json()), 'trials differ'
+	print('Optimizer: 1 shard, 4 shards and local chunks match')
+
+async def check_server(n):
+	summary, ruins = MC(Fragile(), START, END).collect(n)
+	expected = MC.summarize(summary, n)
+	job = { 'type': 'sim', 'model': 'check_local:Fragile', 'start': START, 'end': END, 'n': n, 'seed': 0 }
+	js = server.JobServer(port=0, workers=2, chunk=1)
+	async with await js.serve():
+		async for msg in server.submit([job], js.port):
+			assert msg['event'] != 'error', msg['error']
+			if msg['event'] == 'result':
+				result = msg['result']
+	js.close()
+	assert result['summary'] == json.loads(json.dumps(expected)), 'server summary differs'
+	assert result['failure_rate'] == len(ruins) / n
+	print('Job server: {} runs in chunks of 1 match a local run'.format(n))
+
+def main(count, optimize):
+	procs, addrs = start_workers(count)
+	try:
+		check_shards(addrs, 12)
+		if optimize:
+			check_trials(addrs, 2000)
+		asyncio.run(check_server(10))
+	finally:
+		for proc in procs:
+			proc.terminate()
+			proc.wait()
+
+if __name__ == '__main__':
+	args = [arg for arg in sys.argv[1:] if arg != '--optimize']
+	main(int(args[0]) if args else 3, '--optimize' in sys.argv)
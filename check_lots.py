@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+
+"""
+Checks LotAccount's lot selection and taxes.
+
+	python check_lots.py
+
+Covers partial sales with and without banked losses, hifo and fifo order,
+harvesting lots at a loss, deficits larger than the lots, and that the lots
+less what's owed always add up to the balance.
+"""
+
+import random
+
+from accounts import LotAccount
+from util import Dist
+
+
+def close(a, b):
+	return abs(a - b) < 1e-6 * max(1, abs(a), abs(b))
+
+def lots_value(acct):
+	return sum(lot[2] for lot in acct.lots) * acct.price
+
+def check_invariants(acct):
+	assert close(lots_value(acct) - acct.owed, acct.balance()), (lots_value(acct), acct.owed, acct.balance())
+	assert close(sum(lot[2] * lot[3] for lot in acct.lots) - acct.owed, acct.basis), (acct.lots, acct.owed, acct.basis)
+
+def account(**kwargs):
+	acct = LotAccount(**kwargs)
+	acct.update(2021, 1, 0)
+	return acct
+
+def check_partial_sale():
+	# One long-term lot worth 1000 with 600 of gain: selling v brings in v - 0.6v * 20%
+	acct = account(total=1000, basis=400, tax_rate=0.2)
+	assert close(acct.withdraw(100, 'Spend'), 100)
+	sold = 100 / (1 - 0.6 * 0.2)
+	assert close(acct.balance(), 1000 - sold)
+	assert close(acct.ledger[-1].tax, -0.6 * sold * 0.2)
+	assert len(acct.lots) == 1
+	check_invariants(acct)
+
+	# Banked losses cover part of the gain: v - (0.6v - 50) * 20% = 100
+	acct = account(total=1000, basis=400, tax_rate=0.2)
+	acct.losses = 50
+	assert close(acct.withdraw(100, 'Spend'), 100)
+	sold = (100 - 50 * 0.2) / (1 - 0.6 * 0.2)
+	assert close(acct.balance(), 1000 - sold)
+	assert close(acct.losses, 0)
+	check_invariants(acct)
+
+	# Banked losses cover all of the gain, so the sale is untaxed and uses up 60 of them
+	acct = account(total=1000, basis=400, tax_rate=0.2)
+	acct.losses = 300
+	assert close(acct.withdraw(100, 'Spend'), 100)
+	assert close(acct.balance(), 900)
+	assert close(acct.losses, 240)
+	check_invariants(acct)
+	print('Partial sales: taxed, partly offset and fully offset by losses')
+
+def check_order():
+	# 100 units bought at 1, then 50 more at 2 once the price has doubled
+	for order, left in (('hifo', { 1: 100, 2: 25 }), ('fifo', { 1: 75, 2: 50 })):
+		acct = account(tax_rate=0, order=order)
+		acct.deposit(100, 'Buy')
+		acct.apply_rate(1.0)
+		acct.update(2021, 2, 0)
+		acct.deposit(100, 'Buy')
+		acct.withdraw(50, 'Spend')
+		units = { lot[3]: lot[2] for lot in acct.lots }
+		assert units.keys() == left.keys() and all(close(units[cost], left[cost]) for cost in left), (order, units)
+		check_invariants(acct)
+	print('Order: hifo sells the highest cost lot first, fifo the oldest')
+
+def check_harvest():
+	# 100 units bought at 1 and 50 at 2, then the price falls back to 1
+	acct = account(tax_rate=0.2)
+	acct.deposit(100, 'Buy')
+	acct.apply_rate(1.0)
+	acct.update(2021, 2, 0)
+	acct.deposit(100, 'Buy')
+	acct.apply_rate(-0.5)
+	acct.harvest()
+	# Only the lot at a loss is rebought, banking the loss without changing the balance
+	assert close(acct.losses, 50)
+	assert close(acct.balance(), 150)
+	assert all(close(lot[3], 1) for lot in acct.lots)
+	check_invariants(acct)
+	# The banked loss offsets the next gain: selling 100 after the price doubles gains exactly 50
+	acct.apply_rate(1.0)
+	assert close(acct.withdraw(100, 'Spend'), 100)
+	assert close(acct.ledger[-1].tax, 0)
+	assert close(acct.losses, 0)
+	check_invariants(acct)
+	print('Harvest: losses banked and used to offset later gains')
+
+def check_deficit():
+	# A deficit sells lots with tax, like a withdrawal
+	acct = account(total=1000, basis=400, tax_rate=0.2)
+	acct.deposit(-100, 'Deficit')
+	assert close(acct.balance(), 1000 - 100 / (1 - 0.6 * 0.2))
+	check_invariants(acct)
+
+	# What the lots can't cover is owed, and paid back before new deposits buy lots
+	acct = account(total=100, basis=100, tax_rate=0.2)
+	acct.deposit(-300, 'Deficit')
+	assert not acct.lots and close(acct.owed, 200) and close(acct.balance(), -200)
+	check_invariants(acct)
+	acct.apply_rate(0.5)
+	assert close(acct.balance(), -200)
+	acct.deposit(250, 'Income')
+	assert close(acct.owed, 0) and close(acct.balance(), 50) and close(lots_value(acct), 50)
+	check_invariants(acct)
+	print('Deficits: taxed, and amounts owed are repaid first')
+
+def check_random(seed=3):
+	random.seed(seed)
+	acct = LotAccount(total=1000, basis=600, beta=1, alpha=Dist(0, 0.1), tax_rate=0.2, short_tax_rate=0.4)
+	for year in range(2021, 2041):
+		for month in range(1, 13):
+			acct.update(year, month, random.gauss(0.008, 0.05))
+			r = random.random()
+			if r < 0.3:
+				acct.deposit(-random.uniform(0, 800), 'Deficit')
+			elif r < 0.7:
+				acct.deposit(random.uniform(0, 800), 'Income')
+			else:
+				acct.withdraw(random.uniform(0, 500), 'Spend')
+			if month == 6:
+				acct.harvest()
+			check_invariants(acct)
+			assert acct.owed < 0.01 or lots_value(acct) < 1e-6
+	print('Random deposits, deficits, withdrawals and harvests keep lots - owed = balance')
+
+def main():
+	check_partial_sale()
+	check_order()
+	check_harvest()
+	check_deficit()
+	check_random()
+
+if __name__ == '__main__':
+	main()
@@ -140,15 +140,16 @@ class Model1(Model):
 		etrade.sweep(ml, 250000)
 
 
-model = Model1()
-mc = MC(model, 2021, 2070)
+if __name__ == '__main__':
+	model = Model1()
+	mc = MC(model, 2021, 2070)
 
-# Run a single simulation and display yearly account totals
-mc.run_once()
+	# Run a single simulation and display yearly account totals
+	mc.run_once()
 
-# Write out ledgers files containing all individual transactions for the latest simulation run
-model.report('ledgers')
+	# Write out ledgers files containing all individual transactions for the latest simulation run
+	model.report('ledgers')
 
-# Run 100 simulations and summarize the range of outcomes
-mc.run(100)
+	# Run 100 simulations and summarize the range of outcomes
+	mc.run(100)
 
@@ -40,54 +40,81 @@ class Symbol(object):
 		self.dividends = np.array(dividends)
 
 class Portfolio(object):
-	def __init__(self, syms, cash=0, taxed_account=False, n=1):
+	def __init__(self, syms, cash=0, taxed_account=False, n=1, chunk=None):
+		"""
+		Simulates n paths, chunk paths at a time if given, so memory doesn't grow with n
+		"""
 		self.symbols = [Symbol(sym) for sym in syms]
-		bal = { sym: np.zeros(n) for sym in syms }
-		bal['cash'] = np.full(n, cash)
-		self.balance = pd.DataFrame(data=bal , dtype=np.float32)
-		self.taxed_account = taxed_account
 		self.n = n
+		self.chunk = min(chunk or n, n)
+		# Balances of each path (rows) in each symbol and cash (columns), updated in place
+		# so every chunk reuses the same buffer
+		self.values = np.zeros((self.chunk, len(syms) + 1))
+		self.values[:, -1] = cash
+		self.taxed_account = taxed_account
+
+	@property
+	def balance(self):
+		"""
+		Read-only snapshot of the balances as a DataFrame. Writing to it raises; change values instead.
+		"""
+		values = self.values.copy()
+		values.flags.writeable = False
+		return pd.DataFrame(values, columns=[sym.sym for sym in self.symbols] + ['cash'])
 
 	def reset(self, cash):
-		self.balance[:] = 0
-		self.balance['cash'][:] = cash
+		self.values[:] = 0
+		self.values[:, -1] = cash
 
 	def total(self):
-		return self.balance.sum(axis=1)
+		return pd.Series(self.values.sum(axis=1))
+
+	def chunked(self):
+		return self.chunk < self.n
+
+	def blocks(self):
+		"""
+		The (index, size) of each chunk of paths
+		"""
+		return [[b, min(self.chunk, self.n - b * self.chunk)] for b in range(-(-self.n // self.chunk))]
 
 	def update(self, dates):
 		tax_rate = DIVIDEND_TAX_RATE if self.taxed_account else 0
-		for sym in self.symbols:
-			self.balance[sym.sym] *= sym.returns[dates]
-			self.balance['cash'] += sym.dividends[dates] * self.balance[sym.sym] * (1 - tax_rate)
+		for i, sym in enumerate(self.symbols):
+			self.values[:, i] *= sym.returns[dates]
+			self.values[:, -1] += sym.dividends[dates] * self.values[:, i] * (1 - tax_rate)
 
 	def contribute(self, amt):
-		self.balance['cash'] += amt
+		self.values[:, -1] += amt
 
 	def rebalance(self, target):
-		tot = self.total()
+		self.rebalance_weights(np.array([target[sym.sym] for sym in self.symbols]))
 
-		tgt = { sym: np.full(self.n, target[sym]) for sym in target }
-		tgt['cash'] = np.zeros(self.n)
-		target_df = pd.DataFrame(tgt)
+	def rebalance_weights(self, weights):
+		"""
+		weights is an array of target weights in the same order as self.symbols
+		"""
+		tot = self.values.sum(axis=1)[:, None]
+		target = np.append(weights, 0)
 
 		if self.taxed_account:
 			# For taxed accounts, only use dividends and contributions to rebalance (don't sell)
-			expected = target_df.mul(tot, axis=0)
-			diffs = expected - self.balance
+			diffs = tot * target - self.values
 			diffs *= diffs > 0
-			pct = self.balance['cash'] / diffs.sum(axis=1)
-			self.balance += diffs.mul(pct, axis=0)
-			self.balance['cash'][:] = 0
+			with np.errstate(divide='ignore', invalid='ignore'):
+				pct = self.values[:, -1:] / diffs.sum(axis=1)[:, None]
+			self.values += diffs * pct
+			self.values[:, -1] = 0
 
 		else:
 			# For untaxed accounts, sell to rebalance if necessary
-			self.balance = target_df.mul(tot, axis=0)
+			np.multiply(tot, target, out=self.values)
 
 	def __repr__(self):
 		tot = self.total().mean()
-		rows = [(sym.sym, self.balance[sym.sym].mean()) for sym in self.symbols]
-		rows += [('cash', self.balance['cash'].mean()), ('Total', tot)]
+		means = self.values.mean(axis=0)
+		rows = [(sym.sym, means[i]) for i, sym in enumerate(self.symbols)]
+		rows += [('cash', means[-1]), ('Total', tot)]
 		return '\n'.join(["{:>5s} {:>6s} {:>13s}".format(
 			sym,
 			'{:.1f}%'.format(amt * 100 / tot),
@@ -99,20 +126,76 @@ class Simulator(object):
 		self.portfolio = portfolio
 
 	def run(self, strategy, init, years, quiet=False):
+		if self.portfolio.chunked():
+			raise Exception('Portfolio holds {} of its {} paths at a time; use Optimizer.partial() or run_blocks() to run them all'.format(
+				self.portfolio.chunk, self.portfolio.n))
+		self.run_chunk(strategy, init, years, quiet)
+
+	def run_chunk(self, strategy, init, years, quiet=False):
+		"""
+		Simulates one chunk of paths in the portfolio's balances
+		"""
+		if not self.portfolio.taxed_account:
+			return self.run_untaxed(strategy, init, years, quiet)
+		weights, conts = strategy.schedule([sym.sym for sym in self.portfolio.symbols], years * 12)
 		self.portfolio.reset(init)
 		for year in range(years):
 			for quarter in range(4):
 				# Pick a random quarter from history to use to update prices
-				qtr = np.random.randint(HISTORY_YEARS * 12 - 3, size=self.portfolio.n)
+				qtr = np.random.randint(HISTORY_YEARS * 12 - 3, size=self.portfolio.chunk)
 				for month in range(3):
-					dt = (year * 12 + quarter * 3 + month) / (years * 12)
-					self.portfolio.contribute(strategy.contribution(dt))
-					self.portfolio.rebalance(strategy.target(dt))
+					m = year * 12 + quarter * 3 + month
+					self.portfolio.contribute(conts[m])
+					self.portfolio.rebalance_weights(weights[m])
 					self.portfolio.update(qtr + month)
 			if not quiet:
 				print(year)
 				print(self.portfolio)
 
+	def run_untaxed(self, strategy, init, years, quiet=False):
+		# Untaxed accounts are fully rebalanced every month, so each month's growth is
+		# just the target-weighted return and the whole path has a closed form:
+		#   total[m] = (total[m-1] + cont[m]) * growth[m]
+		#            = cumgrowth[m] * (init + sum(cont[k] / cumgrowth[k-1] for k <= m))
+		p = self.portfolio
+		months = years * 12
+		weights, conts = strategy.schedule([sym.sym for sym in p.symbols], months)
+
+		# Same random quarters, in the same order, as the month-by-month simulation
+		qtrs = [np.random.randint(HISTORY_YEARS * 12 - 3, size=p.chunk) for _ in range(years * 4)]
+		dates = np.array([qtr + month for qtr in qtrs for month in range(3)])
+
+		growth = np.zeros((months, p.chunk))
+		for i, sym in enumerate(p.symbols):
+			growth += weights[:, i:i+1] * (sym.returns * (1 + sym.dividends))[dates]
+		cum = np.cumprod(growth, axis=0)
+		prev = np.vstack([np.ones((1, p.chunk)), cum[:-1]])
+		totals = cum * (init + np.cumsum(conts[:, None] / prev, axis=0))
+
+		def holdings(m):
+			# Balances right after month m's update
+			before = (init if m == 0 else totals[m-1]) + conts[m]
+			for i, sym in enumerate(p.symbols):
+				p.values[:, i] = weights[m, i] * before * sym.returns[dates[m]]
+			p.values[:, -1] = sum(sym.dividends[dates[m]] * p.values[:, i] for i, sym in enumerate(p.symbols))
+
+		if not quiet:
+			for year in range(years):
+				holdings(year * 12 + 11)
+				print(year)
+				print(p)
+		holdings(months - 1)
+
+	def run_blocks(self, strategy, init, years, seed, blocks):
+		"""
+		Runs each (index, size) block of paths seeded by (seed, index), reusing the
+		portfolio's chunk of balances, and yields the final totals of the block's paths
+		"""
+		for block, size in blocks:
+			np.random.seed([seed, block])
+			self.run_chunk(strategy, init, years, quiet=True)
+			yield self.portfolio.total().values[:size]
+
 
 class Strategy(object):
 	def __init__(self, targets, cont):
@@ -125,6 +208,13 @@ class Strategy(object):
 		return self.targets
 	def contribution(self, dt):
 		return self.cont
+	def schedule(self, syms, months):
+		"""
+		Target weights (months x syms) and contributions (months) for each month of a simulation.
+		Strategies whose targets change over time override this along with target() and contribution().
+		"""
+		weights = np.tile([self.targets[sym] for sym in syms], (months, 1))
+		return weights, np.full(months, float(self.cont))
 	def with_gradient(self, gradient, step_size=1):
 		new_targets = { t: self.targets[t] * (1 + gradient.get(t, 0) * step_size) for t in self.targets }
 		return Strategy(new_targets, self.cont)
@@ -154,6 +244,11 @@ class InterpolatingStrategy(Strategy):
 		return { sym: t1[sym] * (1 - dt) + t2[sym] * dt for sym in t1 }
 	def contribution(self, dt):
 		return self.s1.contribution(dt) * (1 - dt) + self.s2.contribution(dt) * dt
+	def schedule(self, syms, months):
+		w1, c1 = self.s1.schedule(syms, months)
+		w2, c2 = self.s2.schedule(syms, months)
+		dt = np.arange(months) / months
+		return w1 * (1 - dt[:, None]) + w2 * dt[:, None], c1 * (1 - dt) + c2 * dt
 	def with_gradient(self, gradient, step_size=1):
 		g1 = { k: gradient[(i, k)] for i, k in gradient if i == 1 }
 		g2 = { k: gradient[(i, k)] for i, k in gradient if i == 2 }
@@ -169,19 +264,82 @@ class InterpolatingStrategy(Strategy):
 			'{:.1f}%'.format(t2[sym] * 100)) for sym in t1])
 
 
+class PiecewiseStrategy(Strategy):
+	"""
+	Follows strategies[i] from starts[i] until the next start, where starts are fractions of
+	the simulation and the first one is 0. Each piece sees its own span as 0 to 1, so an
+	InterpolatingStrategy piece glides from one allocation to another over that span.
+	"""
+	def __init__(self, strategies, starts):
+		self.strategies = strategies
+		self.starts = starts
+	def piece(self, dt):
+		i = np.searchsorted(self.starts, dt, side='right') - 1
+		end = self.starts[i + 1] if i + 1 < len(self.starts) else 1
+		return self.strategies[i], (dt - self.starts[i]) / (end - self.starts[i])
+	def params(self):
+		return [(i, k) for i, s in enumerate(self.strategies) for k in s.params()]
+	def target(self, dt):
+		s, t = self.piece(dt)
+		return s.target(t)
+	def contribution(self, dt):
+		s, t = self.piece(dt)
+		return s.contribution(t)
+	def schedule(self, syms, months):
+		bounds = [int(round(start * months)) for start in self.starts] + [months]
+		pieces = [s.schedule(syms, hi - lo) for s, lo, hi in zip(self.strategies, bounds, bounds[1:])]
+		return np.concatenate([w for w, c in pieces]), np.concatenate([c for w, c in pieces])
+	def with_gradient(self, gradient, step_size=1):
+		return PiecewiseStrategy([s.with_gradient({ k: gradient[(j, k)] for j, k in gradient if j == i }, step_size*len(self.strategies))
+			for i, s in enumerate(self.strategies)], self.starts)
+	def randomize(self, factor):
+		return PiecewiseStrategy([s.randomize(factor) for s in self.strategies], self.starts)
+	def __repr__(self):
+		return '\n'.join(['From {:.0f}%:\n{}'.format(start * 100, s) for s, start in zip(self.strategies, self.starts)])
+
+
+class ScheduleStrategy(Strategy):
+	"""
+	A fixed schedule of monthly target weights (months x syms) and contributions
+	"""
+	def __init__(self, syms, weights, conts):
+		self.syms = syms
+		self.weights = weights
+		self.conts = conts
+	def params(self):
+		return []
+	def month(self, dt):
+		return min(int(dt * len(self.conts)), len(self.conts) - 1)
+	def target(self, dt):
+		return dict(zip(self.syms, self.weights[self.month(dt)]))
+	def contribution(self, dt):
+		return self.conts[self.month(dt)]
+	def schedule(self, syms, months):
+		idx = [self.syms.index(sym) for sym in syms]
+		return self.weights[:months, idx], self.conts[:months]
+	def with_gradient(self, gradient, step_size=1):
+		return self
+	def randomize(self, factor):
+		return self
+
+
 class Optimizer(object):
-	def __init__(self, portfolio, init, goal, years):
+	def __init__(self, portfolio, init, goal, years, seed=17, cache=None, workers=None):
 		self.portfolio = portfolio
 		self.init = init
 		self.goal = goal
 		self.years = years
+		self.seed = seed
+		self.cache = cache
+		self.workers = workers
 		self.sim = Simulator(portfolio)
 
 	# strategy: strategy to optimize
 	# step_size: update step size
 	# delta: gradient test step size
 	# epsilon: stopping condition
-	def optimize(self, strategy, step_size, delta, epsilon, randomize_factor=0.0):
+	# progress: called with the iteration and success rate after each iteration
+	def optimize(self, strategy, step_size, delta, epsilon, randomize_factor=0.0, progress=None):
 		success_rate = 0
 
 		i = 0
@@ -190,6 +348,8 @@ class Optimizer(object):
 			old_success_rate = success_rate
 			success_rate = self.trial(strategy)
 			print('Success rate: {:.1f}%\n'.format(success_rate * 100))
+			if progress:
+				progress(i, success_rate)
 
 			if abs(success_rate - old_success_rate) < epsilon:
 				return strategy
@@ -217,12 +377,41 @@ class Optimizer(object):
 		success_rate = self.trial(strategy, seed=4)
 		print('Cross-validate: {:.1f}%\n'.format(success_rate * 100))
 
-	def trial(self, strategy, seed=17):
+	def trial(self, strategy, seed=None):
+		seed = self.seed if seed is None else seed
+		if self.cache is None:
+			return self.run_trial(strategy, seed)
+		p = self.portfolio
+		schedule = strategy.schedule([sym.sym for sym in p.symbols], self.years * 12)
+		data = [(sym.sym, sym.returns, sym.dividends) for sym in p.symbols]
+		key = self.cache.key('Optimizer.trial', schedule, data, p.taxed_account, p.n, p.chunk, self.init, self.goal, self.years, seed, self.workers is not None)
+		return self.cache.cached(key, lambda: self.run_trial(strategy, seed))
+
+	def run_trial(self, strategy, seed):
+		if self.workers or self.portfolio.chunked():
+			# Only the success count is needed, so skip the summary statistics
+			partial = self.partial(strategy, seed, stats=False)
+			return partial.successes / partial.n
 		np.random.seed(seed)
 		self.sim.run(strategy, self.init, self.years, quiet=True)
 		success = (self.portfolio.total() > self.goal).sum()
 		return success / self.portfolio.n
 
+	def partial(self, strategy, seed=None, stats=True):
+		"""
+		Success count and (if stats) summary statistics of the final totals, merged across chunks or workers.
+		Chunks and shards seed each block of paths separately, so they match each other (for the
+		same chunk size) but not unchunked local trials.
+		"""
+		from shard import Coordinator, Partial
+		seed = self.seed if seed is None else seed
+		if self.workers:
+			return Coordinator(self.workers).trial(self, strategy, seed, stats=stats)
+		partial = Partial()
+		for totals in self.sim.run_blocks(strategy, self.init, self.years, seed, self.portfolio.blocks()):
+			partial.add_totals(self.years, totals, self.goal, stats)
+		return partial
+
 
 # Standard ETFs used by WealthFront
 wf_tickers = [
@@ -280,5 +469,5 @@ def run_opt():
 	strategy = opt.optimize(strategy, step_size=4, delta=0.1, epsilon=0.001, randomize_factor=0.2)
 	opt.cross_validate(strategy)
 
-run_opt()
-
+if __name__ == '__main__':
+	run_opt()
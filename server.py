@@ -0,0 +1,216 @@
+#!/usr/bin/env python3
+
+"""
+Local job server for running many simulations and optimizations from one
+warm process pool.
+
+Start it with
+
+	python server.py [port]
+
+and send it jobs as JSON lines over a TCP connection to localhost. Each job
+gets back a stream of JSON lines: "queued", "progress" and finally "result"
+(or "error"). For example
+
+	{"type": "sim", "model": "main:Model1", "start": 2021, "end": 2070, "n": 100, "seed": 0}
+	{"type": "optimize", "tickers": ["VTI", "LQD"], "n": 10000, "init": 1000000, "goal": 2200000, "years": 10}
+"""
+
+import asyncio
+import contextlib
+import importlib
+import io
+import itertools
+import json
+import multiprocessing
+import sys
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+
+from sim import MC, Model
+
+PORT = 8765
+CHUNK = 25
+
+# Per-process caches, so each worker only imports models and downloads prices once
+models = dict()
+portfolios = dict()
+
+def warm():
+	import accounts
+	import taxes
+	try:
+		import optimize
+	except ImportError:
+		pass
+
+def load_model(spec):
+	"""
+	An instance of the Model subclass named by module:class. Specs come from the
+	network, so anything else is refused rather than called.
+	"""
+	if spec not in models:
+		module, name = spec.split(':')
+		cls = getattr(importlib.import_module(module), name)
+		if not (isinstance(cls, type) and issubclass(cls, Model)):
+			raise Exception('{} is not a Model'.format(spec))
+		models[spec] = cls()
+	return models[spec]
+
+def run_paths(job, first, count):
+	mc = MC(load_model(job['model']), job['start'], job['end'])
+	summary, ruins = mc.collect(count, job.get('summary_every_n_years', 10), job.get('deficit', False), job.get('annual', False), first)
+	return { year: dict(stats) for year, stats in summary.items() }, [(r.year, r.month, r.note, r.amt) for r in ruins]
+
+def run_optimize(job, progress=None):
+	import optimize
+	key = (tuple(job['tickers']), job.get('taxed', True), job['n'], job.get('chunk'))
+	if key not in portfolios:
+		portfolios[key] = optimize.Portfolio(job['tickers'], n=job['n'], taxed_account=job.get('taxed', True), chunk=job.get('chunk'))
+	portfolio = portfolios[key]
+	opt = optimize.Optimizer(portfolio, job['init'], job['goal'], job['years'], seed=job.get('seed', 17))
+	low, high = job.get('contributions', [4000, 8000])
+	strategy = optimize.InterpolatingStrategy(
+		optimize.EqualStrategy(portfolio, contributions=low),
+		optimize.EqualStrategy(portfolio, contributions=high))
+	with contextlib.redirect_stdout(io.StringIO()):
+		strategy = opt.optimize(strategy,
+			step_size=job.get('step_size', 4),
+			delta=job.get('delta', 0.1),
+			epsilon=job.get('epsilon', 0.001),
+			randomize_factor=job.get('randomize_factor', 0.2),
+			progress=None if progress is None else lambda i, rate: progress.put({ 'iteration': i, 'success_rate': rate }))
+	return {
+		'start': strategy.target(0),
+		'end': strategy.target(1),
+		'success_rate': opt.trial(strategy),
+	}
+
+
+class JobServer(object):
+	def __init__(self, port=PORT, workers=None, chunk=CHUNK):
+		self.port = port
+		self.chunk = chunk
+		self.pool = ProcessPoolExecutor(max_workers=workers, initializer=warm)
+		# Pool processes send optimizer progress back through the manager's queues
+		self.manager = multiprocessing.Manager()
+		self.ids = itertools.count(1)
+
+	async def serve(self):
+		server = await asyncio.start_server(self.handle, '127.0.0.1', self.port)
+		self.port = server.sockets[0].getsockname()[1]
+		return server
+
+	async def handle(self, reader, writer):
+		lock = asyncio.Lock()
+
+		async def send(msg):
+			async with lock:
+				writer.write((json.dumps(msg) + '\n').encode())
+				await writer.drain()
+
+		tasks = []
+		while True:
+			line = await reader.readline()
+			if not line:
+				break
+			try:
+				job = json.loads(line)
+			except ValueError as e:
+				await send({ 'event': 'error', 'error': 'Bad job: {}'.format(e) })
+				continue
+			tasks.append(asyncio.ensure_future(self.run_job(next(self.ids), job, send)))
+		await asyncio.gather(*tasks)
+		writer.close()
+
+	async def run_job(self, id, job, send):
+		await send({ 'id': id, 'event': 'queued' })
+		try:
+			if job.get('type', 'sim') == 'sim':
+				result = await self.run_sim(id, job, send)
+			elif job['type'] == 'optimize':
+				result = await self.run_optimize(id, job, send)
+			else:
+				raise Exception('Unknown job type {}'.format(job['type']))
+		except Exception as e:
+			await send({ 'id': id, 'event': 'error', 'error': '{}: {}'.format(type(e).__name__, e) })
+		else:
+			await send({ 'id': id, 'event': 'result', 'result': result })
+
+	async def run_sim(self, id, job, send):
+		loop = asyncio.get_event_loop()
+		n, seed = job['n'], job.get('seed', 0)
+		futures = [loop.run_in_executor(self.pool, run_paths, job, first, min(self.chunk, seed + n - first))
+			for first in range(seed, seed + n, self.chunk)]
+
+		summary = defaultdict(lambda: defaultdict(list))
+		ruins = []
+		done = 0
+		for future in asyncio.as_completed(futures):
+			chunk, chunk_ruins = await future
+			for year, stats in chunk.items():
+				for key, vals in stats.items():
+					summary[year][key] += vals
+			ruins += chunk_ruins
+			done += 1
+			await send({ 'id': id, 'event': 'progress', 'done': done, 'total': len(futures) })
+
+		# A chunk whose runs all stopped before a summary year sends nothing for it, so pad
+		# every year to n runs, counting the missing ones as zero like MC.collect does
+		for stats in summary.values():
+			for vals in stats.values():
+				vals += [0] * (n - len(vals))
+				vals.sort()
+		return {
+			'summary': MC.summarize(summary, n),
+			'failure_rate': len(ruins) / n,
+			'ruins': sorted(ruins),
+		}
+
+	async def run_optimize(self, id, job, send):
+		loop = asyncio.get_event_loop()
+		queue = self.manager.Queue()
+		future = loop.run_in_executor(self.pool, run_optimize, job, queue)
+		# The queue ends with None once the job is done, even if it failed
+		future.add_done_callback(lambda f: queue.put(None))
+		while True:
+			msg = await loop.run_in_executor(None, queue.get)
+			if msg is None:
+				break
+			await send(dict({ 'id': id, 'event': 'progress' }, **msg))
+		return await future
+
+	def close(self):
+		self.pool.shutdown()
+		self.manager.shutdown()
+
+
+async def submit(jobs, port=PORT):
+	"""
+	Send jobs to a running server and yield each message it sends back until every job has finished
+	"""
+	reader, writer = await asyncio.open_connection('127.0.0.1', port)
+	for job in jobs:
+		writer.write((json.dumps(job) + '\n').encode())
+	await writer.drain()
+	writer.write_eof()
+	left = len(jobs)
+	while left > 0:
+		line = await reader.readline()
+		if not line:
+			break
+		msg = json.loads(line)
+		if msg['event'] in ('result', 'error'):
+			left -= 1
+		yield msg
+	writer.close()
+
+
+async def main(port):
+	server = JobServer(port)
+	async with await server.serve() as s:
+		print('Listening on 127.0.0.1:{}'.format(server.port))
+		await s.serve_forever()
+
+if __name__ == '__main__':
+	asyncio.run(main(int(sys.argv[1]) if len(sys.argv) > 1 else PORT))
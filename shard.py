@@ -0,0 +1,369 @@
+#!/usr/bin/env python3
+
+"""
+Sharded Monte Carlo across worker nodes.
+
+Start a worker on each node with
+
+	python shard.py worker [port] [host]
+
+and pass their (host, port) addresses to MC(workers=...) or Optimizer(workers=...).
+Workers listen on 127.0.0.1 unless given another host, e.g. 0.0.0.0. The
+coordinator splits the runs into ranges, each worker sends back a Partial
+(quantile sketches, exact moments and failure counts) for its range, and the
+merged Partial is the same however the runs were split.
+
+The protocol has no authentication or encryption: anyone who can reach a
+worker can have it import modules and run models by name. Only listen on
+networks where every host is trusted.
+"""
+
+import asyncio
+import json
+import math
+import sys
+from collections import defaultdict
+from fractions import Fraction
+
+import server
+from sim import MC
+
+PORT = 9001
+ACCURACY = 0.005
+BLOCK = 1000
+
+
+class Sketch(object):
+	"""
+	Quantile sketch with fixed logarithmic buckets, so quantiles are within ACCURACY
+	(relative) and merging is adding bucket counts
+	"""
+	gamma = (1 + ACCURACY) / (1 - ACCURACY)
+
+	def __init__(self):
+		self.pos = defaultdict(int)
+		self.neg = defaultdict(int)
+		self.zero = 0
+
+	def count(self):
+		return sum(self.pos.values()) + sum(self.neg.values()) + self.zero
+
+	def add(self, x, count=1):
+		if abs(x) < 0.001:
+			self.zero += count
+		elif x > 0:
+			self.pos[math.ceil(math.log(x, self.gamma))] += count
+		else:
+			self.neg[math.ceil(math.log(-x, self.gamma))] += count
+
+	def add_all(self, values):
+		import numpy as np
+		values = np.asarray(values, dtype=float)
+		zero = np.abs(values) < 0.001
+		self.zero += int(zero.sum())
+		for sign, buckets in ((1, self.pos), (-1, self.neg)):
+			vals = values[~zero & (values * sign > 0)] * sign
+			idx, counts = np.unique(np.ceil(np.log(vals) / math.log(self.gamma)), return_counts=True)
+			for i, c in zip(idx.tolist(), counts.tolist()):
+				buckets[int(i)] += c
+
+	def merge(self, other):
+		for i, c in other.pos.items():
+			self.pos[i] += c
+		for i, c in other.neg.items():
+			self.neg[i] += c
+		self.zero += other.zero
+
+	def value(self, i):
+		return 2 * self.gamma ** i / (self.gamma + 1)
+
+	def quantile(self, q, n=None):
+		"""
+		The q quantile, counting values missing from the n total as zero
+		"""
+		count = self.count()
+		n = n or count
+		rank = int(n * q)
+		buckets = [(-self.value(i), c) for i, c in sorted(self.neg.items(), reverse=True)]
+		buckets += [(0, self.zero + n - count)]
+		buckets += [(self.value(i), c) for i, c in sorted(self.pos.items())]
+		for val, c in buckets:
+			if rank < c:
+				return val
+			rank -= c
+		return buckets[-1][0]
+
+	def to_json(self):
+		# Sorted, so the same buckets always serialize the same way however they were merged
+		return { 'pos': dict(sorted(self.pos.items())), 'neg': dict(sorted(self.neg.items())), 'zero': self.zero }
+
+	@staticmethod
+	def from_json(data):
+		s = Sketch()
+		s.pos.update({ int(i): c for i, c in data['pos'].items() })
+		s.neg.update({ int(i): c for i, c in data['neg'].items() })
+		s.zero = data['zero']
+		return s
+
+
+class Moments(object):
+	"""
+	Count, sum and sum of squares kept as exact fractions, so merging doesn't depend on order.
+	add_all rounds a batch of values to cents so it can sum them as integers.
+	"""
+	def __init__(self, count=0, total=Fraction(0), squares=Fraction(0)):
+		self.count = count
+		self.total = total
+		self.squares = squares
+
+	def add(self, x):
+		x = Fraction(x)
+		self.count += 1
+		self.total += x
+		self.squares += x * x
+
+	def add_all(self, values):
+		import numpy as np
+		cents = np.round(np.asarray(values, dtype=float) * 100).astype(np.int64).astype(object)
+		self.count += len(cents)
+		self.total += Fraction(int(cents.sum()), 100)
+		self.squares += Fraction(int((cents * cents).sum()), 10000)
+
+	def merge(self, other):
+		self.count += other.count
+		self.total += other.total
+		self.squares += other.squares
+
+	def mean(self, n=None):
+		return float(self.total / (n or self.count)) if n or self.count else 0
+
+	def std(self, n=None):
+		n = n or self.count
+		return math.sqrt(float(self.squares / n - (self.total / n) ** 2)) if n else 0
+
+	def to_json(self):
+		return [self.count, str(self.total), str(self.squares)]
+
+	@staticmethod
+	def from_json(data):
+		return Moments(data[0], Fraction(data[1]), Fraction(data[2]))
+
+
+class Partial(object):
+	"""
+	Mergeable results for a range of runs: a sketch and moments of each summary value
+	(per year and category, or of final totals for optimizer trials), the number of
+	runs, failures and successes, and failures grouped by month and cause.
+	"""
+	def __init__(self):
+		self.n = 0
+		self.successes = 0
+		self.sketches = defaultdict(lambda: defaultdict(Sketch))
+		self.moments = defaultdict(lambda: defaultdict(Moments))
+		self.ruins = dict()
+
+	def add(self, year, key, val):
+		self.sketches[year][key].add(val)
+		self.moments[year][key].add(val)
+
+	def add_totals(self, year, totals, goal, stats=True):
+		"""
+		Final totals of a block of optimizer trial paths, or just how many succeeded if not stats
+		"""
+		self.n += len(totals)
+		self.successes += int((totals > goal).sum())
+		if stats:
+			self.sketches[year]['Total'].add_all(totals)
+			self.moments[year]['Total'].add_all(totals)
+
+	@staticmethod
+	def from_paths(summary, ruins, n):
+		p = Partial()
+		p.n = n
+		for year, stats in summary.items():
+			for key, vals in stats.items():
+				for val in vals:
+					p.add(year, key, val)
+		for year, month, note, amt in ruins:
+			count, total = p.ruins.get((year, month, note), (0, Fraction(0)))
+			p.ruins[(year, month, note)] = (count + 1, total + Fraction(amt))
+		return p
+
+	def merge(self, other):
+		self.n += other.n
+		self.successes += other.successes
+		for year, stats in other.sketches.items():
+			for key, sketch in stats.items():
+				self.sketches[year][key].merge(sketch)
+				self.moments[year][key].merge(other.moments[year][key])
+		for k, (count, total) in other.ruins.items():
+			c, t = self.ruins.get(k, (0, Fraction(0)))
+			self.ruins[k] = (c + count, t + total)
+		return self
+
+	def failures(self):
+		return sum(count for count, total in self.ruins.values())
+
+	def summarize(self):
+		"""
+		Same as MC.summarize, with runs that stopped early counted as zero
+		"""
+		out = dict()
+		for year, stats in self.sketches.items():
+			out[year] = dict()
+			for key, sketch in stats.items():
+				out[year][key] = [sketch.quantile(q, self.n) for q in MC.percentiles] + [self.moments[year][key].mean(self.n)]
+		return out
+
+	def shortfalls(self):
+		"""
+		The failures as Shortfalls, with the average amount for each month and cause
+		"""
+		from util import Shortfall
+		return [Shortfall(year, month, note, float(total / count)) for (year, month, note), (count, total) in sorted(self.ruins.items())
+			for i in range(count)]
+
+	def to_json(self):
+		return {
+			'n': self.n,
+			'successes': self.successes,
+			'sketches': [[year, key, s.to_json(), self.moments[year][key].to_json()]
+				for year, stats in sorted(self.sketches.items()) for key, s in sorted(stats.items())],
+			'ruins': [[year, month, note, count, str(total)] for (year, month, note), (count, total) in sorted(self.ruins.items())],
+		}
+
+	@staticmethod
+	def from_json(data):
+		p = Partial()
+		p.n = data['n']
+		p.successes = data['successes']
+		for year, key, sketch, moments in data['sketches']:
+			p.sketches[year][key] = Sketch.from_json(sketch)
+			p.moments[year][key] = Moments.from_json(moments)
+		for year, month, note, count, total in data['ruins']:
+			p.ruins[(year, month, note)] = (count, Fraction(total))
+		return p
+
+
+def run_shard(job):
+	if job['type'] == 'mc':
+		summary, ruins = server.run_paths(job, job['first'], job['count'])
+		return Partial.from_paths(summary, ruins, job['count'])
+	if job['type'] == 'trial':
+		return run_trial_blocks(job)
+	raise Exception('Unknown shard type {}'.format(job['type']))
+
+def run_trial_blocks(job):
+	"""
+	Optimizer trials for blocks of paths, each seeded by (seed, block) so a block's
+	paths are the same whichever worker runs it
+	"""
+	import numpy as np
+	import optimize
+	key = (tuple(job['tickers']), job['taxed'], job['block'])
+	if key not in server.portfolios:
+		server.portfolios[key] = optimize.Portfolio(job['tickers'], n=job['block'], taxed_account=job['taxed'])
+	portfolio = server.portfolios[key]
+	strategy = optimize.ScheduleStrategy(job['tickers'], np.array(job['weights']), np.array(job['contributions']))
+	sim = optimize.Simulator(portfolio)
+	p = Partial()
+	for totals in sim.run_blocks(strategy, job['init'], job['years'], job['seed'], job['blocks']):
+		p.add_totals(job['years'], totals, job['goal'], job['stats'])
+	return p
+
+
+class Worker(object):
+	def __init__(self, port=PORT, host='127.0.0.1'):
+		self.port = port
+		self.host = host
+
+	async def serve(self):
+		# Shards run one at a time since they share the worker's models
+		self.lock = asyncio.Lock()
+		server = await asyncio.start_server(self.handle, self.host, self.port)
+		self.port = server.sockets[0].getsockname()[1]
+		return server
+
+	async def handle(self, reader, writer):
+		loop = asyncio.get_event_loop()
+		while True:
+			line = await reader.readline()
+			if not line:
+				break
+			try:
+				async with self.lock:
+					partial = await loop.run_in_executor(None, run_shard, json.loads(line))
+				msg = { 'partial': partial.to_json() }
+			except Exception as e:
+				msg = { 'error': '{}: {}'.format(type(e).__name__, e) }
+			writer.write((json.dumps(msg) + '\n').encode())
+			await writer.drain()
+		writer.close()
+
+
+class Coordinator(object):
+	"""
+	Hands out shards to workers, given as (host, port) pairs, and merges their partials
+	"""
+	def __init__(self, workers):
+		self.workers = workers
+
+	async def run(self, shards):
+		queue = list(reversed(shards))
+		partials = []
+		errors = []
+
+		async def work(host, port):
+			reader, writer = await asyncio.open_connection(host, port)
+			while queue:
+				shard = queue.pop()
+				writer.write((json.dumps(shard) + '\n').encode())
+				await writer.drain()
+				msg = json.loads(await reader.readline())
+				if 'error' in msg:
+					errors.append(msg['error'])
+					break
+				partials.append(Partial.from_json(msg['partial']))
+			writer.close()
+
+		await asyncio.gather(*[work(host, port) for host, port in self.workers])
+		if errors:
+			raise Exception('Shard failed: {}'.format(errors[0]))
+		merged = Partial()
+		for p in partials:
+			merged.merge(p)
+		return merged
+
+	def mc(self, spec, start, end, n, summary_every_n_years=10, deficit=False, annual=False, shards=None):
+		shards = shards or len(self.workers)
+		size = -(-n // shards)
+		jobs = [{ 'type': 'mc', 'model': spec, 'start': start, 'end': end, 'first': first, 'count': min(size, n - first),
+			'summary_every_n_years': summary_every_n_years, 'deficit': deficit, 'annual': annual } for first in range(0, n, size)]
+		return asyncio.run(self.run(jobs))
+
+	def trial(self, opt, strategy, seed, shards=None, block=None, stats=True):
+		p = opt.portfolio
+		syms = [sym.sym for sym in p.symbols]
+		weights, conts = strategy.schedule(syms, opt.years * 12)
+		# Chunked portfolios use their chunks as blocks, so sharded trials match local ones
+		block = block or (p.chunk if p.chunked() else BLOCK)
+		blocks = [[b, min(block, p.n - b * block)] for b in range(-(-p.n // block))]
+		shards = shards or len(self.workers)
+		size = -(-len(blocks) // shards)
+		jobs = [{ 'type': 'trial', 'tickers': syms, 'taxed': p.taxed_account, 'block': block,
+			'weights': weights.tolist(), 'contributions': conts.tolist(), 'init': opt.init, 'goal': opt.goal,
+			'years': opt.years, 'seed': seed, 'stats': stats, 'blocks': blocks[i:i + size] } for i in range(0, len(blocks), size)]
+		return asyncio.run(self.run(jobs))
+
+
+async def main(port, host):
+	worker = Worker(port, host)
+	async with await worker.serve() as s:
+		print('Worker listening on {}:{}'.format(host, worker.port))
+		await s.serve_forever()
+
+if __name__ == '__main__':
+	if len(sys.argv) < 2 or sys.argv[1] != 'worker':
+		print('Usage: shard.py worker [port] [host]')
+		sys.exit(1)
+	asyncio.run(main(int(sys.argv[2]) if len(sys.argv) > 2 else PORT, sys.argv[3] if len(sys.argv) > 3 else '127.0.0.1'))
@@ -1,8 +1,10 @@
 
 import random
 import os
+import sys
+import time
 from collections import defaultdict
-from util import Dist
+from util import Dist, Solvency
 
 class Model(object):
 	def __init__(self):
@@ -10,27 +12,75 @@ class Model(object):
 		self.expenses = dict()
 		self.accounts = dict()
 		self.transfers = dict()
+		self.solvency = Solvency()
+		self.template = None
+		self.horizon = None
 
 	def run(self):
 		pass
 
-	def update(self, year, month, market):
+	def flows(self):
+		return list(self.incomes.values()) + list(self.expenses.values()) + list(self.accounts.values()) + list(self.transfers.values())
+
+	def reset(self):
+		"""
+		Put the model back in its initial state. The first call runs setup() and saves
+		the initial state of every flow; later calls just restore it. Set template to
+		None to make the next reset() run setup() again.
+
+		Only flows registered with income(), expense(), account() and transfer() are
+		restored. Attributes that setup() sets on the model itself, and flows kept
+		anywhere else, carry over from one run to the next.
+		"""
+		if self.template is None:
+			self.setup()
+			self.template = [(flow, flow.save()) for flow in self.flows()]
+			self.horizon = None
+		else:
+			for flow, saved in self.template:
+				flow.restore(saved)
+
+	def precompute(self, start, end):
+		"""
+		Precompute the deterministic flows (fixed increases) once for all runs from start to end.
+		Call right after reset().
+		"""
+		if self.horizon != (start, end):
+			for flow in self.flows():
+				flow.precompute(start, end)
+			self.horizon = (start, end)
+
+	def update(self, year, month, market, months=1):
 		self.year = year
 		self.month = month
+		self.months = months
 		for acct in self.accounts.values():
-			acct.update(year, month, market)
+			acct.update(year, month, market, months)
 		for inc in self.incomes.values():
-			inc.update(year, month)
+			inc.update(year, month, months=months)
 		for exp in self.expenses.values():
-			exp.update(year, month)
+			exp.update(year, month, months=months)
 		for tr in self.transfers.values():
-			tr.update(year, month)
+			tr.update(year, month, months=months)
+
+	def settle(self):
+		for flow in self.flows():
+			flow.settle()
+
+	def record(self, ledgers):
+		"""
+		Turn the accounts' ledgers on or off. Quiet Monte Carlo runs skip them.
+		"""
+		for flow in self.flows():
+			if hasattr(flow, 'ledger'):
+				flow.recording = ledgers
 
 	def income(self, name, inc=None):
 		if inc is None:
 			return self.incomes[name]
 		self.incomes[name] = inc
 		inc.set_name(name)
+		inc.solvency = self.solvency
 		return inc
 
 	def expense(self, name, exp=None):
@@ -38,6 +88,7 @@ class Model(object):
 			return self.expenses[name]
 		self.expenses[name] = exp
 		exp.set_name(name)
+		exp.solvency = self.solvency
 		return exp
 
 	def account(self, name, acct=None):
@@ -45,6 +96,7 @@ class Model(object):
 			return self.accounts[name]
 		self.accounts[name] = acct
 		acct.set_name(name)
+		acct.solvency = self.solvency
 		return acct
 
 	def transfer(self, name, tr=None):
@@ -52,6 +104,7 @@ class Model(object):
 			return self.transfers[name]
 		self.transfers[name] = tr
 		tr.set_name(name)
+		tr.solvency = self.solvency
 		return tr
 
 	def report(self, outdir):
@@ -62,16 +115,27 @@ class Model(object):
 				f.write(str(acct))
 
 class Sim(object):
-	def __init__(self, model, start, end, summary_every_n_years=10, ignore_accounts=['Income', 'RSUs']):
+	"""
+	With annual=True the model is stepped once a year (month 12, covering all
+	12 months) with one annual market return and annual flow totals. Accounts
+	grow half the year before the flows and half after, so flows land mid-year.
+	With ledgers=False the accounts don't record their transactions. With
+	deficit=True the run keeps going after a shortfall instead of stopping.
+	"""
+	def __init__(self, model, start, end, summary_every_n_years=10, ignore_accounts=['Income', 'RSUs'], annual=False, ledgers=True, deficit=False):
 		self.model = model
 		self.start = start
 		self.end = end
 		self.ignore_accounts = ignore_accounts
 		self.summary_every_n_years = summary_every_n_years
+		self.annual = annual
+		self.ledgers = ledgers
+		self.deficit = deficit
 		self.summary = dict()
-		
+		self.ruin = None
 
-	def fmt(self, n, width=13):
+	@staticmethod
+	def fmt(n, width=13):
 		if abs(n) < 0.001:
 			n = 0
 		return ('{:>%ds}' % width).format('${:,.0f}'.format(n))
@@ -86,18 +150,34 @@ class Sim(object):
 
 	def run(self, quiet=False):
 		market = Dist(0.1, 0.18)
-		self.model.setup()
+		solvency = self.model.solvency
+		solvency.reset(self.deficit)
+		self.model.reset()
+		self.model.record(self.ledgers)
+		self.model.precompute(self.start, self.end)
 
 		headers = ''.join(['{:>13s}'.format(acct.name) for acct in self.accounts()])
 		if not quiet:
 			print('Year' + headers + '{:>13s}'.format('Total'))
 
+		steps = [(12, 12)] if self.annual else [(month, 1) for month in range(1, 13)]
+
 		for year in range(self.start, self.end):
 			if not quiet:
 				print(('%d' % year) + ''.join([self.fmt(bal) for bal in self.balances()]))
-			for month in range(1, 13):
-				self.model.update(year, month, market.get_monthly())
-				self.model.run()
+			for month, months in steps:
+				if months == 1:
+					self.model.update(year, month, market.get_monthly())
+					self.model.run()
+				else:
+					self.model.update(year, month, (market.mean, market.std, random.gauss(0, 1)), months)
+					self.model.run()
+					self.model.settle()
+				if not solvency.solvent() and not solvency.deficit:
+					self.ruin = solvency.first
+					if not quiet:
+						print('Out of money: {}'.format(self.ruin))
+					return
 
 			if year % self.summary_every_n_years == 0:
 				self.summary[year] = defaultdict(int)
@@ -108,45 +188,146 @@ class Sim(object):
 						self.summary[year][acct.category] += acct.balance()
 					self.summary[year]['Total'] = total
 
+		self.ruin = solvency.first
 		if not quiet:
 			print(('%d' % self.end) + ''.join([self.fmt(bal) for bal in self.balances()]))
 
 class MC(object):
-	def __init__(self, model, start, end):
+	percentiles = [0.1, 0.2, 0.5, 0.8]
+
+	def __init__(self, model, start, end, cache=None, workers=None):
 		self.model = model
 		self.start = start
 		self.end = end
+		self.cache = cache
+		self.workers = workers
 
 	def run_once(self):
 		sim = Sim(self.model, self.start, self.end)
 		sim.run()
 
-	def run(self, n, summary_every_n_years=10):
+	def collect(self, n, summary_every_n_years=10, deficit=False, annual=False, first=0):
+		"""
+		Run simulations seeded first..first+n-1 and return their sorted summary values and shortfalls
+		"""
+		if self.cache is None:
+			return self.simulate(n, summary_every_n_years, deficit, annual, first)
+		from cache import model_key
+		mkey = model_key(self.model)
+		if mkey is None:
+			return self.simulate(n, summary_every_n_years, deficit, annual, first)
+		key = self.cache.key('MC.collect', mkey, self.start, self.end, n, summary_every_n_years, deficit, annual, first)
+		return self.cache.cached(key, lambda: self.simulate(n, summary_every_n_years, deficit, annual, first))
+
+	def simulate(self, n, summary_every_n_years, deficit, annual, first):
 		summary = defaultdict(lambda: defaultdict(list))
-		fails = 0
-		for i in range(n):
+		ruins = []
+		for i in range(first, first + n):
 			random.seed(i)
-			sim = Sim(self.model, self.start, self.end, summary_every_n_years)
-			try:
-				sim.run(True)
-			except:
-				fails += 1
+			sim = Sim(self.model, self.start, self.end, summary_every_n_years, annual=annual, ledgers=False, deficit=deficit)
+			sim.run(True)
+			if sim.ruin is not None:
+				ruins.append(sim.ruin)
 			for year, stats in sim.summary.items():
 				for key, val in stats.items():
 					summary[year][key].append(val)
 
+		# Runs that stopped early count as zero for the years they didn't reach
 		for year, stats in summary.items():
+			for key, vals in stats.items():
+				stats[key] = sorted([0] * (n - len(vals)) + vals)
+		return { year: dict(stats) for year, stats in summary.items() }, ruins
+
+	@staticmethod
+	def summarize(summary, n):
+		"""
+		10%, 20%, 50%, 80% and mean of each summary value
+		"""
+		return { year: { key: [vals[int(n * p)] for p in MC.percentiles] + [sum(vals) / n] for key, vals in stats.items() }
+			for year, stats in summary.items() }
+
+	def spec(self):
+		"""
+		module:class of the model, for workers to import
+		"""
+		module = type(self.model).__module__
+		if module == '__main__':
+			module = os.path.splitext(os.path.basename(sys.modules['__main__'].__file__))[0]
+		return '{}:{}'.format(module, type(self.model).__name__)
+
+	def sharded(self, n, summary_every_n_years=10, deficit=False, annual=False):
+		"""
+		Run simulations seeded 0..n-1 on the workers and return the merged shard.Partial.
+		It's the same however the runs were split, so it's cached without the workers.
+		"""
+		from shard import Coordinator, Partial
+		def compute():
+			return Coordinator(self.workers).mc(self.spec(), self.start, self.end, n, summary_every_n_years, deficit, annual).to_json()
+		if self.cache is None:
+			return Partial.from_json(compute())
+		from cache import model_key
+		mkey = model_key(self.model)
+		if mkey is None:
+			return Partial.from_json(compute())
+		key = self.cache.key('MC.sharded', mkey, self.start, self.end, n, summary_every_n_years, deficit, annual)
+		return Partial.from_json(self.cache.cached(key, compute))
+
+	def run(self, n, summary_every_n_years=10, deficit=False, annual=False):
+		if self.workers:
+			partial = self.sharded(n, summary_every_n_years, deficit, annual)
+			stats, ruins = partial.summarize(), partial.shortfalls()
+		else:
+			summary, ruins = self.collect(n, summary_every_n_years, deficit, annual)
+			stats = MC.summarize(summary, n)
+
+		for year, stats in sorted(stats.items()):
 			print('\n{:>18}  {:>13} {:>13} {:>13} {:>13} {:>13}'.format(year, '10%', '20%', '50%', '80%', 'Mean'))
 			for key, vals in sorted(stats.items()):
-				if len(vals) < n:
-					vals = [0] * (n - len(vals)) + vals
-				vals = sorted(vals)
-				print('{:>18}: {} {} {} {} {}'.format(
-					key, 
-					sim.fmt(vals[int(n * 0.1)]),
-					sim.fmt(vals[int(n * 0.2)]),
-					sim.fmt(vals[int(n * 0.5)]),
-					sim.fmt(vals[int(n * 0.8)]),
-					sim.fmt(sum(vals) / n), 
-				))
-		print('\nFailure rate: {:.1f}%'.format(100 * fails / n))
+				print('{:>18}: {} {} {} {} {}'.format(key, *[Sim.fmt(val) for val in vals]))
+		print('\nFailure rate: {:.1f}%'.format(100 * len(ruins) / n))
+		self.report_ruin(ruins, n)
+
+	def validate(self, n, summary_every_n_years=10):
+		"""
+		Run n simulations with monthly and with annual steps and show how far the annual results drift
+		"""
+		t = time.process_time()
+		monthly, monthly_ruins = self.collect(n, summary_every_n_years)
+		monthly_time = time.process_time() - t
+		t = time.process_time()
+		annual, annual_ruins = self.collect(n, summary_every_n_years, annual=True)
+		annual_time = time.process_time() - t
+
+		def drift(a, m):
+			return '{:>+8.1f}%'.format(0 if m == 0 else 100 * (a - m) / abs(m))
+
+		for year, stats in monthly.items():
+			print('\n{:>18}  {:>13} {:>13} {:>9} {:>13} {:>13} {:>9}'.format(year, 'Monthly 50%', 'Annual 50%', 'Drift', 'Monthly mean', 'Annual mean', 'Drift'))
+			for key, vals in sorted(stats.items()):
+				avals = annual[year][key]
+				m50, a50 = vals[int(n * 0.5)], avals[int(n * 0.5)]
+				mmean, amean = sum(vals) / n, sum(avals) / n
+				print('{:>18}: {} {} {} {} {} {}'.format(
+					key, Sim.fmt(m50), Sim.fmt(a50), drift(a50, m50), Sim.fmt(mmean), Sim.fmt(amean), drift(amean, mmean)))
+		print('\nFailure rate: {:.1f}% monthly, {:.1f}% annual'.format(100 * len(monthly_ruins) / n, 100 * len(annual_ruins) / n))
+		print('CPU time: {:.2f}s monthly, {:.2f}s annual ({:.1f}x)'.format(monthly_time, annual_time, monthly_time / annual_time))
+
+	def report_ruin(self, ruins, n):
+		if not ruins:
+			return
+		years = sorted(r.year + (r.month - 1) / 12 for r in ruins)
+		print('\n{:>18}  {:>13} {:>13} {:>13} {:>13} {:>13}'.format('Out of money', '10%', '20%', '50%', '80%', 'Mean'))
+		print('{:>18}: {} {} {} {} {}'.format(
+			'Year',
+			*['{:>13.1f}'.format(years[int(len(years) * p)]) for p in MC.percentiles],
+			'{:>13.1f}'.format(sum(years) / len(years)),
+		))
+		for decade in range(int(years[0]) // 10 * 10, self.end, 10):
+			failed = len([y for y in years if y < decade + 10])
+			print('{:>18}: {:>12.1f}%'.format('By {}'.format(decade + 10), 100 * failed / n))
+		causes = defaultdict(list)
+		for r in ruins:
+			causes[r.note].append(r.amt)
+		print('')
+		for note, amts in sorted(causes.items(), key=lambda c: -len(c[1])):
+			print('{:>18}: {:>5d} runs, average shortfall {}'.format(note, len(amts), Sim.fmt(sum(amts) / len(amts))))
@@ -6,10 +6,10 @@ class IncomeTax(object):
 		self.rates = rates
 		self.taxes = []
 
-	def tax(self, total, marginal):
+	def tax(self, total, marginal, periods=12):
 		tax = 0
-		taxed = total * 12
-		left_to_tax = marginal * 12
+		taxed = total * periods
+		left_to_tax = marginal * periods
 		i = 0
 		while left_to_tax > 0:
 			if taxed < self.brackets[i]:
@@ -19,13 +19,13 @@ class IncomeTax(object):
 				left_to_tax -= amt
 			i += 1
 
-		return tax / 12
+		return tax / periods
 
 	def calculate(self, accounts):
 		total = 0
 		for acct in accounts:
 			bal = acct.balance()
-			self.taxes.append((acct, self.tax(total, bal)))
+			self.taxes.append((acct, self.tax(total, bal, 12 / acct.months)))
 			total += bal
 
 	def commit(self):
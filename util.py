@@ -7,12 +7,33 @@ class Dist(object):
 		self.mean = mean
 		self.std = std
 
+	def constant(self):
+		return self.std == 0
+
+	# Zero-variance distributions skip the random draw
+
 	def get(self):
+		if self.std == 0:
+			return self.mean
 		return random.gauss(0, 1) * self.std + self.mean
 
 	def get_monthly(self):
+		if self.std == 0:
+			return self.mean / 12
 		return random.gauss(0, 1) * self.std / math.sqrt(12) + self.mean / 12
 
+	def get_months(self, n):
+		# Sum of n monthly draws
+		if self.std == 0:
+			return self.mean * n / 12
+		return random.gauss(0, 1) * self.std * math.sqrt(n) / math.sqrt(12) + self.mean * n / 12
+
+	def get_total(self, n):
+		# Sum of n draws
+		if self.std == 0:
+			return self.mean * n
+		return random.gauss(0, 1) * self.std * math.sqrt(n) + self.mean * n
+
 class Ledger(object):
 	def __init__(self, year, month, note, amt, tax, bal):
 		self.year = year
@@ -29,3 +50,38 @@ class Ledger(object):
 			'-' if abs(self.tax) < 0.001 else '${:,.2f}'.format(self.tax),
 			'${:,.2f}'.format(self.bal),
 		)
+
+class Shortfall(object):
+	def __init__(self, year, month, note, amt):
+		self.year = year
+		self.month = month
+		self.note = note
+		self.amt = amt
+
+	def __str__(self):
+		return '{} {:2d} {:<30s} {:>15s}'.format(
+			self.year, self.month, self.note, '${:,.2f}'.format(self.amt))
+
+class Solvency(object):
+	"""
+	Records the shortfalls of a single simulation run instead of raising.
+	With deficit=True the unpaid amount is charged to the first account
+	so the run can continue with a negative balance.
+	"""
+	def __init__(self, deficit=False):
+		self.reset(deficit)
+
+	def reset(self, deficit=False):
+		self.deficit = deficit
+		self.first = None
+		self.total = 0
+		self.count = 0
+
+	def solvent(self):
+		return self.first is None
+
+	def record(self, year, month, note, amt):
+		if self.first is None:
+			self.first = Shortfall(year, month, note, amt)
+		self.total += amt
+		self.count += 1